@@ -1,17 +1,70 @@
-from typing import List, Tuple
+from typing import List, Tuple, Dict
 from transformers import AutoModelForPreTraining, AutoTokenizer, \
     AutoModelForSequenceClassification, AdamW
-from torch.utils.data import DataLoader
+from transformers.modeling_utils import Conv1D
+from torch.utils.data import DataLoader, Dataset
 from sentence_transformers import SentenceTransformer
 from functools import partial
+from contextlib import contextmanager
+from collections import OrderedDict
 import os
+import sys
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 from pytorch_lightning.utilities.memory import garbage_collection_cuda
 
+@contextmanager
+def inference_context(device):
+    """
+    Disables gradient tracking and enables mixed precision when running on cuda.
+
+    Args:
+        device: Device that inference is run on
+    """
+    # inference_mode is cheaper than no_grad, but only exists in newer torch versions
+    no_grad = getattr(torch, "inference_mode", torch.no_grad)
+    is_cuda = str(device).startswith("cuda")
+
+    with no_grad(), torch.cuda.amp.autocast(enabled=is_cuda):
+        yield
+
+def to_device(features, device):
+    """
+    Moves a dictionary of tensors (such as tokenizer output) to the device.
+    Copies to cuda are made from pinned memory, so they do not block the host.
+
+    Args:
+        features: Dictionary of tensors
+        device: Device to move the tensors to
+    """
+    if str(device).startswith("cuda"):
+        return {k: v.pin_memory().to(device, non_blocking=True) for k, v in features.items()}
+
+    return {k: v.to(device) for k, v in features.items()}
+
+def conv1d_to_linear(module):
+    """
+    Replaces the transformers Conv1D layers (used by GPT-2) in the module
+    with equivalent nn.Linear layers, in place.
+
+    Args:
+        module: Module to replace the layers in
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            # Conv1D stores its weight transposed compared to nn.Linear
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+
 class BaseModel:
     """
     The base class for a model.
@@ -47,13 +100,23 @@ class Finetunable(pl.LightningModule):
         pl.LightningModule.__init__(self)
 
         self.batch_size = 1
+        # Throughput stops improving past a handful of workers
+        self.num_workers = min(8, os.cpu_count() or 0)
 
     def finetune(self, dataset, validation_split: float = 0.15, epochs: int = 20, batch_size: int = None,
-                optimal_batch_size: int = None, early_stopping: bool = True, trainer = None):
+                optimal_batch_size: int = None, early_stopping: bool = True, trainer = None,
+                use_gradient_checkpointing: bool = False):
         self.batch_size = batch_size or 1
 
+        if getattr(self, "_quantization", None):
+            raise ValueError("Quantized models cannot be finetuned, initialise the model without quantization")
+
         if not torch.cuda.is_available():
             raise Exception("You need a cuda capable (Nvidia) GPU for finetuning")
+
+        # Before the batch size search, so that it can make use of the saved memory
+        if use_gradient_checkpointing:
+            self.enable_gradient_checkpointing()
         
         len_train = int(len(dataset) * (1 - validation_split))
         len_valid = len(dataset) - len_train
@@ -102,15 +165,53 @@ class Finetunable(pl.LightningModule):
         self.model.eval()
         print("Training finished! Save your model for later with backprop.save or upload it with backprop.upload")
 
+    def enable_gradient_checkpointing(self):
+        """
+        Recomputes activations in the backward pass instead of storing them,
+        which trades extra compute for a much lower memory usage.
+        """
+        enabled = 0
+        for module in self.model.modules():
+            if hasattr(module, "gradient_checkpointing_enable"):
+                module.gradient_checkpointing_enable()
+                enabled += 1
+            elif hasattr(getattr(module, "config", None), "gradient_checkpointing"):
+                # Older transformers versions toggle it through the config
+                module.config.gradient_checkpointing = True
+                enabled += 1
+
+        if enabled == 0:
+            raise ValueError("This model does not support gradient checkpointing")
+
     def train_dataloader(self):
-        return DataLoader(self.dataset_train,
-            batch_size=self.batch_size,
-            num_workers=os.cpu_count() or 0)
+        return self.dataloader(self.dataset_train, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(self.dataset_valid,
+        return self.dataloader(self.dataset_valid)
+
+    def dataloader(self, dataset, shuffle: bool = False):
+        """
+        Creates a DataLoader that prefetches pinned batches, so host to device copies
+        (done with non_blocking by pytorch lightning) overlap with compute.
+        """
+        # Models saved before num_workers existed do not have it
+        num_workers = getattr(self, "num_workers", min(8, os.cpu_count() or 0))
+        loader_kwargs = {}
+
+        if num_workers > 0:
+            loader_kwargs["persistent_workers"] = True
+            loader_kwargs["prefetch_factor"] = 4
+
+            # Forked workers share the model's memory instead of pickling it
+            if sys.platform.startswith("linux"):
+                loader_kwargs["multiprocessing_context"] = "fork"
+
+        return DataLoader(dataset,
             batch_size=self.batch_size,
-            num_workers=os.cpu_count() or 0)
+            shuffle=shuffle,
+            num_workers=num_workers,
+            pin_memory=torch.cuda.is_available(),
+            **loader_kwargs)
     
     def configure_optimizers(self):
         raise NotImplementedError("configure_optimizers must be implemented")
@@ -133,21 +234,62 @@ class PathModel(BaseModel):
         tokenizer_path (optional): Path to the tokenizer
         init_tokenizer (optional): Callable to initialise tokenizer from path
         device (optional): Device for inference. Defaults to "cuda" if available.
+        quantization (optional): Lower precision to load the model in for inference.
+            "fp16" halves the weights (cuda only), "int8" dynamically quantizes linear layers (cpu only).
+            Quantized models are for inference only and cannot be finetuned.
+
+    Note:
+        Set the BACKPROP_COMPILE environment variable to 1 to compile the model
+        with torch.compile when running on cuda (requires a torch version that supports it).
+        The first calls are slow while the model is compiled for the input shapes.
+        Compiled models cannot be pickled, so they cannot be saved with backprop.save.
     """
+    # Only worth it for models that are called with a few fixed input shapes
+    compilable = True
+
+    # Names of attributes holding caches (see cache_get and cache_put), which are not pickled
+    cache_attributes = ()
+
     def __init__(self, model_path, init_model, tokenizer_path=None,
-                init_tokenizer=None, device=None):
+                init_tokenizer=None, device=None, quantization: str = None):
         self.init_model = init_model
         self.init_tokenizer = init_tokenizer
         self.model_path = model_path
         self.tokenizer_path = tokenizer_path
         self._model_device = device
+        self._quantization = quantization
 
         if self._model_device is None:
             self._model_device = "cuda" if torch.cuda.is_available() else "cpu"
 
+        is_cuda = str(self._model_device).startswith("cuda")
+
         # Initialise
         self.model = self.init_model(model_path).eval().to(self._model_device)
 
+        if quantization == "fp16":
+            if not is_cuda:
+                raise ValueError("fp16 quantization is only supported on cuda")
+
+            self.model = self.model.half()
+        elif quantization == "int8":
+            if is_cuda:
+                raise ValueError("int8 quantization is only supported on cpu")
+
+            # Dynamic quantization only handles nn.Linear, which GPT-2 style Conv1D layers are equivalent to
+            conv1d_to_linear(self.model)
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear},
+                                                            dtype=torch.qint8)
+        elif quantization is not None:
+            raise ValueError(f"Unsupported quantization: {quantization}")
+
+        self._compiled = False
+        if os.environ.get("BACKPROP_COMPILE", "0") == "1" and is_cuda and \
+                self.compilable and hasattr(self.model, "compile"):
+            # Compiles in place, so generate and encode go through the compiled forward too
+            self.model.compile(mode="reduce-overhead", fullgraph=False)
+            self._compiled = True
+
         # Not all models need tokenizers
         if self.tokenizer_path:
             self.tokenizer = self.init_tokenizer(self.tokenizer_path)
@@ -156,6 +298,50 @@ class PathModel(BaseModel):
     def __call__(self, *args, **kwargs):
         return self.model(*args, **kwargs)
 
+    def to(self, device):
+        if getattr(self, "_quantization", None) == "int8" and str(device).startswith("cuda"):
+            raise ValueError("int8 quantized models can only run on cpu")
+
+        return super().to(device)
+
+    def __getstate__(self):
+        # Caches are rebuilt on demand and can be large, so they are not saved with the model
+        parent_getstate = getattr(super(), "__getstate__", None)
+        state = dict(parent_getstate() if parent_getstate else self.__dict__)
+
+        for name in self.cache_attributes:
+            state.pop(name, None)
+
+        return state
+
+    def cache_get(self, name: str, key):
+        """
+        Returns the value cached for the key in the named LRU cache, or None if it is not cached.
+        """
+        cache = getattr(self, name, None)
+
+        if cache is None or key not in cache:
+            return None
+
+        cache.move_to_end(key)
+        return cache[key]
+
+    def cache_put(self, name: str, key, value, max_size: int):
+        """
+        Caches the value for the key in the named LRU cache, evicting the least
+        recently used entry once the cache holds more than max_size entries.
+        """
+        cache = getattr(self, name, None)
+
+        if cache is None:
+            cache = OrderedDict()
+            setattr(self, name, cache)
+
+        cache[key] = value
+
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+
 
 class HuggingModel(PathModel):
     """
@@ -169,10 +355,12 @@ class HuggingModel(PathModel):
         init_tokenizer (optional): Callable to initialise tokenizer from path
             Defaults to AutoTokenizer from huggingface.
         device (optional): Device for inference. Defaults to "cuda" if available.
+        quantization (optional): Lower precision to load the model in for inference ("fp16" or "int8").
     """
     def __init__(self, model_path, tokenizer_path=None,
                 model_class=AutoModelForPreTraining,
-                tokenizer_class=AutoTokenizer, device=None):
+                tokenizer_class=AutoTokenizer, device=None,
+                quantization: str = None):
         # Usually the same
         if not tokenizer_path:
             tokenizer_path = model_path
@@ -184,14 +372,49 @@ class HuggingModel(PathModel):
             init_model = self.init_model
             init_tokenizer = self.init_tokenizer
             device = self._model_device
+            quantization = getattr(self, "_quantization", None)
         else:
             init_model = model_class.from_pretrained
             init_tokenizer = tokenizer_class.from_pretrained
 
+            # Prefer the rust backed tokenizers
+            if tokenizer_class == AutoTokenizer:
+                init_tokenizer = partial(init_tokenizer, use_fast=True)
+
         return PathModel.__init__(self, model_path, tokenizer_path=tokenizer_path,
                                 init_model=init_model,
                                 init_tokenizer=init_tokenizer,
-                                device=device)
+                                device=device, quantization=quantization)
+
+
+class PairEncodeDataset(Dataset):
+    """
+    Dataset of text pairs and their similarity scores that is tokenized lazily,
+    so DataLoader workers do the tokenization in parallel with training.
+
+    Attributes:
+        text_pairs: List of text pairs
+        similarity_scores: List of similarity scores matching the text pairs
+        tokenizer: Tokenizer to encode the texts with
+        max_length: Maximum number of tokens in each text
+    """
+    def __init__(self, text_pairs: List[Tuple[str, str]], similarity_scores: List[float],
+                tokenizer, max_length: int = 128):
+        self.text_pairs = text_pairs
+        self.similarity_scores = similarity_scores
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    def __len__(self):
+        return len(self.text_pairs)
+
+    def __getitem__(self, idx):
+        tokens = self.tokenizer(list(self.text_pairs[idx]), truncation=True, max_length=self.max_length,
+                                padding="max_length", return_tensors="pt")
+        score = torch.tensor(self.similarity_scores[idx], dtype=torch.float32)
+
+        return tokens.input_ids[0], tokens.attention_mask[0], \
+            tokens.input_ids[1], tokens.attention_mask[1], score
 
 
 class TextVectorisationModel(PathModel, Finetunable):
@@ -223,14 +446,44 @@ class TextVectorisationModel(PathModel, Finetunable):
     def __call__(self, *args, **kwargs):
         return self.vectorise(*args, **kwargs)
 
-    @torch.no_grad()
     def vectorise(self, *args, **kwargs):
-        return self.model.encode(*args, **kwargs)
+        with inference_context(self._model_device):
+            vectors = self.model.encode(*args, **kwargs)
+
+        # Mixed precision embeddings are returned as float32
+        if isinstance(vectors, torch.Tensor):
+            vectors = vectors.float()
+        elif isinstance(vectors, np.ndarray):
+            vectors = vectors.astype(np.float32, copy=False)
+
+        return vectors
+
+    def embed(self, input_ids, attention_mask):
+        """
+        Gets sentence embeddings for already tokenized input.
+
+        The transformer is called directly and its token embeddings are passed
+        through the remaining modules (pooling etc.) of the sentence transformer.
+        """
+        transformer = self.model[0]
+        if not hasattr(transformer, "auto_model"):
+            return self.model.forward({"input_ids": input_ids, "attention_mask": attention_mask})["sentence_embedding"]
+
+        token_embeddings = transformer.auto_model(input_ids=input_ids, attention_mask=attention_mask,
+                                                return_dict=False)[0]
+        features = {"input_ids": input_ids, "attention_mask": attention_mask,
+                    "token_embeddings": token_embeddings,
+                    "cls_token_embeddings": token_embeddings[:, 0]}
+
+        for module in list(self.model)[1:]:
+            features = module(features)
+
+        return features["sentence_embedding"]
 
     def training_step(self, batch, batch_idx):
-        out1 = self.model.forward({"input_ids": batch["input_ids1"], "attention_mask": batch["attention_mask1"]})["sentence_embedding"]
-        out2 = self.model.forward({"input_ids": batch["input_ids2"], "attention_mask": batch["attention_mask2"]})["sentence_embedding"]
-        scores = batch["scores"]
+        input_ids1, attention_mask1, input_ids2, attention_mask2, scores = batch
+        out1 = self.embed(input_ids1, attention_mask1)
+        out2 = self.embed(input_ids2, attention_mask2)
 
         loss = torch.cosine_similarity(out1, out2)
         loss = F.mse_loss(loss, scores.view(-1))
@@ -239,9 +492,9 @@ class TextVectorisationModel(PathModel, Finetunable):
         return loss
     
     def validation_step(self, batch, batch_idx):
-        out1 = self.model.forward({"input_ids": batch["input_ids1"], "attention_mask": batch["attention_mask1"]})["sentence_embedding"]
-        out2 = self.model.forward({"input_ids": batch["input_ids2"], "attention_mask": batch["attention_mask2"]})["sentence_embedding"]
-        scores = batch["scores"]
+        input_ids1, attention_mask1, input_ids2, attention_mask2, scores = batch
+        out1 = self.embed(input_ids1, attention_mask1)
+        out2 = self.embed(input_ids2, attention_mask2)
 
         loss = torch.cosine_similarity(out1, out2)
         loss = F.mse_loss(loss, scores.view(-1))
@@ -251,28 +504,11 @@ class TextVectorisationModel(PathModel, Finetunable):
     def configure_optimizers(self):
         return AdamW(params=self.model.parameters(), lr=2e-5, eps=1e-6, correct_bias=False)
 
-    def encode(self, row, max_input_length):
-        inp = self.encode_input(row[0], max_length=max_input_length)
-        out = self.encode_output(row[1])
-
-        row = {**inp, **out}
-        return row
-
-    def encode_input(self, text_pair, max_length=128):
-        text1, text2 = text_pair
-        tokens1 = self.model.tokenizer(text1, truncation=True, max_length=max_length, padding="max_length", return_tensors="pt")
-        tokens2 = self.model.tokenizer(text2, truncation=True, max_length=max_length, padding="max_length", return_tensors="pt")
-        return {"input_ids1": tokens1.input_ids[0], "attention_mask1": tokens1.attention_mask[0],
-                "input_ids2": tokens2.input_ids[0], "attention_mask2": tokens2.attention_mask[0]}
-
-    def encode_output(self, similarity_score):
-        return {"scores": torch.tensor([similarity_score], dtype=torch.float32)}
-
     def finetune(self, text_pairs: List[Tuple[str, str]], similarity_scores: List[float],
                 max_input_length=64,
                 validation_split: float = 0.15, epochs: int = 20,
                 batch_size: int = None, early_stopping: bool = True,
-                trainer: pl.Trainer = None):
+                trainer: pl.Trainer = None, use_gradient_checkpointing: bool = False):
         """
         Finetunes the model for the text-vectorisation task.
         
@@ -288,6 +524,7 @@ class TextVectorisationModel(PathModel, Finetunable):
             batch_size: Leave as None to determine the batch size automatically
             early_stopping: Boolean that determines whether to automatically stop when validation loss stops improving
             trainer: Your custom pytorch_lightning trainer
+            use_gradient_checkpointing: Boolean that determines whether to lower memory usage at the cost of slower training (raises ValueError if the model does not support it)
 
         Example::
 
@@ -308,10 +545,12 @@ class TextVectorisationModel(PathModel, Finetunable):
         OPTIMAL_BATCH_SIZE = 128
 
         print("Processing data...")
-        dataset = zip(text_pairs, similarity_scores)
-        dataset = [self.encode(r, max_input_length) for r in dataset]
+        dataset = PairEncodeDataset(text_pairs, similarity_scores, self.model.tokenizer, max_input_length)
 
-        Finetunable.finetune(self, dataset)
+        Finetunable.finetune(self, dataset, validation_split=validation_split,
+            epochs=epochs, batch_size=batch_size, optimal_batch_size=OPTIMAL_BATCH_SIZE,
+            early_stopping=early_stopping, trainer=trainer,
+            use_gradient_checkpointing=use_gradient_checkpointing)
 
 
 class TextGenerationModel(HuggingModel):
@@ -321,9 +560,34 @@ class TextGenerationModel(HuggingModel):
     Attributes:
         *args and **kwargs are passed to HuggingModel's __init__
     """
-    def generate(self, text, **kwargs):
+    # Maximum number of prefixes to keep past key values for
+    prefix_cache_size = 8
+
+    # The sequence length changes at every decoding step, so compiling would keep recompiling
+    compilable = False
+
+    # Cached past key values can be hundreds of MB
+    cache_attributes = ("_prefix_cache",)
+
+    def to(self, device):
+        # Cached past key values live on the old device
+        self._prefix_cache = OrderedDict()
+        return super().to(device)
+
+    def generate(self, text, prefix: str = None, batch_size: int = 8, **kwargs):
         """
         Generate according to the model's generate method.
+
+        Args:
+            text: string or list of strings to generate from
+            prefix (optional): text shared by every input that is prepended to it.
+                For decoder only models, its past key values are computed once and
+                reused across calls, which avoids re-encoding long shared prompts.
+            batch_size (optional): maximum number of inputs to generate for at once.
+                Inputs are batched by length, so that little padding is needed.
+                For decoder only models, only inputs with the same number of tokens are batched,
+                so every input gets the same max_length budget as when generating for it alone.
+            kwargs: passed to the model's generate method
         """
         # Get and remove do_sample or set to False
         do_sample = kwargs.pop("do_sample", None) or False
@@ -349,46 +613,173 @@ class TextGenerationModel(HuggingModel):
                 
             del kwargs["num_generations"]
 
-        is_list = False
-        if isinstance(text, list):
-            is_list = True
+        is_list = isinstance(text, list)
+        inputs = text if is_list else [text]
+
+        if len(inputs) == 0:
+            return []
+
+        # Padding is required to tokenize the whole batch at once
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # Decoder only models continue from the last token, so pad on the left
+        if not self.model.config.is_encoder_decoder:
+            self.tokenizer.padding_side = "left"
+
+        # Encoder-decoder models see the whole input at once, so just prepend it
+        if prefix is not None and self.model.config.is_encoder_decoder:
+            inputs = [prefix + t for t in inputs]
+            prefix = None
+
+        # The cached prefix and the input together have to fit the model
+        max_input_length = None
+        if prefix is not None:
+            prefix_length = len(self.tokenizer(prefix)["input_ids"])
+            max_input_length = self.tokenizer.model_max_length - prefix_length
+
+            if max_input_length <= 0:
+                raise ValueError("The prefix is longer than the model's maximum input length")
+
+        # Batch inputs of similar length together to keep padding to a minimum
+        encodings = self.tokenizer(inputs, truncation=True, max_length=max_input_length)
+        lengths = [len(ids) for ids in encodings["input_ids"]]
+        order = sorted(range(len(inputs)), key=lambda i: lengths[i])
+
+        # Decoder only models count max_length and min_length against the padded input,
+        # so only inputs of the same length can share a batch without changing their output
+        exact_length = not self.model.config.is_encoder_decoder
+
+        batches = []
+        for i in order:
+            fits = len(batches) > 0 and len(batches[-1]) < batch_size
+            if fits and exact_length:
+                fits = lengths[batches[-1][0]] == lengths[i]
+
+            if fits:
+                batches[-1].append(i)
+            else:
+                batches.append([i])
+
+        # Preallocated so that each batch can fill in its inputs' slots independently
+        all_generations = [None] * len(inputs)
+        for batch_indices in batches:
+            batch_encodings = [{k: v[i] for k, v in encodings.items()} for i in batch_indices]
+            batch_generations = self.generate_batch([inputs[i] for i in batch_indices], batch_encodings,
+                                                prefix, do_sample, **kwargs)
+
+            # Put generations back in the original order
+            for i, generations in zip(batch_indices, batch_generations):
+                all_generations[i] = generations
 
+        # Unwrap generation list
+        if (kwargs.get("num_return_sequences") or 1) == 1:
+            output = [generations[0] for generations in all_generations]
+        else:
+            output = all_generations
+
+        # Return single item
         if not is_list:
-            text = [text]
+            output = output[0]
 
-        all_tokens = []
-        for text in text:
-            features = self.tokenizer(text, return_tensors="pt")
+        return output
 
-            for k, v in features.items():
-                features[k] = v.to(self._model_device)
+    def generate_batch(self, text: List[str], encodings: List[Dict], prefix: str, do_sample: bool, **kwargs):
+        """
+        Generates for a list of inputs in a single generate call.
 
-            with torch.no_grad():
-                tokens = self.model.generate(do_sample=do_sample,
-                                            **features, **kwargs)
+        Args:
+            text: list of inputs
+            encodings: tokenizer output (without padding) for each of the inputs
+            prefix: text shared by every input, or None
+            do_sample: whether to sample when generating
+            kwargs: passed to the model's generate method
 
-            all_tokens.append(tokens)
-            
-        value = []
-        for tokens in all_tokens:
-            value.append([self.tokenizer.decode(tokens, skip_special_tokens=True)
-                    for tokens in tokens])
-        
-        output = value
+        Returns a list with the list of generations for each input.
+        """
+        features = self.tokenizer.pad(encodings, padding="longest", return_tensors="pt")
 
-        # Unwrap generation list
-        if kwargs.get("num_return_sequences", 1) == 1:
-            output_unwrapped = []
-            for value in output:
-                output_unwrapped.append(value[0])
+        # The prefix cache needs at least one token of every input to continue from
+        if prefix is not None and features["attention_mask"].sum(dim=1).min() == 0:
+            text = [prefix + t for t in text]
+            prefix = None
+            features = self.tokenizer(text, padding="longest", truncation=True,
+                                    return_tensors="pt")
 
-            output = output_unwrapped
-        
-        # Return single item
-        if not is_list:
-            output = output[0]
+        features = to_device(features, self._model_device)
 
-        return output
+        with inference_context(self._model_device):
+            if prefix is not None:
+                features = self.prepare_prefix_features(prefix, features, do_sample, **kwargs)
+
+            tokens = self.model.generate(do_sample=do_sample,
+                                        **features, **kwargs)
+
+        num_return_sequences = kwargs.get("num_return_sequences") or 1
+        decoded = self.tokenizer.batch_decode(tokens, skip_special_tokens=True)
+
+        # Group the generations of each input together
+        return [decoded[i:i + num_return_sequences]
+                    for i in range(0, len(decoded), num_return_sequences)]
+
+    def get_prefix_past(self, prefix: str):
+        """
+        Returns the token ids and past key values of the prefix, computing them only
+        if the prefix is not already cached.
+        """
+        cached = self.cache_get("_prefix_cache", prefix)
+
+        if cached is not None:
+            return cached
+
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self._model_device)
+        past = self.model(input_ids=prefix_ids, use_cache=True).past_key_values
+
+        self.cache_put("_prefix_cache", prefix, (prefix_ids, past), self.prefix_cache_size)
+        return prefix_ids, past
+
+    def prepare_prefix_features(self, prefix: str, features, do_sample: bool, **kwargs):
+        """
+        Builds generate inputs that continue from the cached past key values of the prefix.
+
+        Only the tokens of each input apart from the last are run through the model here,
+        the last one is left for generate to start from.
+        """
+        prefix_ids, past = self.get_prefix_past(prefix)
+
+        input_ids = features["input_ids"]
+        attention_mask = features["attention_mask"]
+        batch_size, input_length = input_ids.shape
+        prefix_length = prefix_ids.shape[1]
+
+        # Inputs are left padded, so the padding sits between the prefix and the input
+        input_ids = torch.cat([prefix_ids.expand(batch_size, -1), input_ids], dim=1)
+        attention_mask = torch.cat([attention_mask.new_ones(batch_size, prefix_length),
+                                    attention_mask], dim=1)
+
+        # The prefix past has a batch size of 1
+        past = self.model._reorder_cache(past, input_ids.new_zeros(batch_size))
+
+        if input_length > 1:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+
+            past = self.model(input_ids=input_ids[:, prefix_length:-1],
+                            attention_mask=attention_mask[:, :-1],
+                            position_ids=position_ids[:, prefix_length:-1],
+                            past_key_values=past, use_cache=True).past_key_values
+
+        # generate expands inputs for beams and samples, but not the past
+        num_beams = kwargs.get("num_beams") or self.model.config.num_beams
+        num_return_sequences = kwargs.get("num_return_sequences") or self.model.config.num_return_sequences
+        expand_size = num_beams * (num_return_sequences if do_sample else 1)
+
+        if expand_size > 1:
+            expanded_idx = torch.arange(batch_size, device=input_ids.device).repeat_interleave(expand_size)
+            past = self.model._reorder_cache(past, expanded_idx)
+
+        return {"input_ids": input_ids, "attention_mask": attention_mask,
+                "past": past, "use_cache": True}
 
 
 class ClassificationModel(HuggingModel):
@@ -403,46 +794,112 @@ class ClassificationModel(HuggingModel):
         tokenizer_class (optional): Callable to initialise tokenizer from path
             Defaults to AutoTokenizer from huggingface.
         device (optional): Device for inference. Defaults to "cuda" if available.
+        quantization (optional): Lower precision to load the model in for inference ("fp16" or "int8").
     """
     def __init__(self, model_path, tokenizer_path=None,
                 model_class=AutoModelForSequenceClassification,
-                tokenizer_class=AutoTokenizer, device=None):
+                tokenizer_class=AutoTokenizer, device=None,
+                quantization: str = None):
         return super().__init__(model_path, tokenizer_path=tokenizer_path,
                     model_class=model_class, tokenizer_class=tokenizer_class,
-                    device=device)
+                    device=device, quantization=quantization)
+
+    # Compiled models are padded to one of these lengths to limit recompilation
+    padding_buckets = [64, 128, 256, 512]
+
+    # Maximum number of labels to keep tokenized hypotheses for
+    hypothesis_cache_size = 1024
+
+    cache_attributes = ("_hypothesis_cache",)
+
+    def encode_hypothesis(self, label: str):
+        """
+        Returns the token ids (without special tokens) of the hypothesis for the label.
+        Labels tend to be reused across calls, so the ids are cached.
+        """
+        ids = self.cache_get("_hypothesis_cache", label)
+
+        if ids is not None:
+            return ids
 
-    def calculate_probability(self, text, label, device):
         hypothesis = f"This example is {label}."
-        features = self.tokenizer.encode(text, hypothesis, return_tensors="pt",
-                                    truncation=True).to(self._model_device)
-        logits = self.model(features)[0]
-        entail_contradiction_logits = logits[:, [0, 2]]
-        probs = entail_contradiction_logits.softmax(dim=1)
-        prob_label_is_true = probs[:, 1]
-        return prob_label_is_true.item()
+        ids = self.tokenizer(hypothesis, add_special_tokens=False)["input_ids"]
 
+        self.cache_put("_hypothesis_cache", label, ids, self.hypothesis_cache_size)
+        return ids
+
+    def nli_label_ids(self):
+        """
+        Returns the contradiction and entailment label ids of the NLI model.
+        Falls back to the MNLI ordering if the config does not name them.
+        """
+        contradiction_id, entailment_id = 0, 2
+        for label, label_id in self.model.config.label2id.items():
+            if label.lower().startswith("contradiction"):
+                contradiction_id = label_id
+            elif label.lower().startswith("entail"):
+                entailment_id = label_id
+
+        return contradiction_id, entailment_id
 
     def classify(self, text, labels):
         """
         Classifies text, given a set of labels.
         """
-        if isinstance(text, list):
+        is_list = isinstance(text, list)
+
+        if is_list:
             # Must have a consistent amount of examples
             assert(len(text) == len(labels))
-            # TODO: implement proper batching
-            results_list = []
-            for text, labels in zip(text, labels):
-                results = {}
-                for label in labels:
-                    results[label] = self.calculate_probability(text, label, self._model_device)
+        else:
+            text = [text]
+            labels = [labels]
+
+        # Nothing to run through the model
+        if not any(labels):
+            results_list = [{} for _ in labels]
+            return results_list if is_list else results_list[0]
+
+        # Encode each text and hypothesis once, instead of once for every pair
+        text_ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        hypothesis_ids = {label: self.encode_hypothesis(label)
+                            for text_labels in labels for label in text_labels}
+
+        # Every (text, label) pair goes through the model in a single batch
+        pairs = [self.tokenizer.prepare_for_model(ids, hypothesis_ids[label], truncation=True)
+                    for ids, text_labels in zip(text_ids, labels) for label in text_labels]
+
+        if getattr(self, "_compiled", False):
+            # Compiled models specialise on input shapes, so keep the number of lengths small
+            longest = max(len(pair["input_ids"]) for pair in pairs)
+            max_length = next((b for b in self.padding_buckets if b >= longest), longest)
+            features = self.tokenizer.pad(pairs, padding="max_length",
+                                        max_length=max_length, return_tensors="pt")
+        else:
+            features = self.tokenizer.pad(pairs, padding=True, return_tensors="pt")
 
-                results_list.append(results)
+        features = to_device(features, self._model_device)
 
-            return results_list
-        else:
-            results = {}
-            for label in labels:
-                results[label] = self.calculate_probability(
-                    text, label, self._model_device)
+        with inference_context(self._model_device):
+            logits = self.model(**features)[0]
+
+        # Keep the softmax in full precision
+        logits = logits.float()
+        label_ids = torch.tensor(self.nli_label_ids(), device=logits.device)
+        entail_contradiction_logits = logits.index_select(1, label_ids)
+        log_probs = F.log_softmax(entail_contradiction_logits, dim=1)
+
+        # A single device to host copy for all pairs
+        probs_label_is_true = log_probs[:, 1].exp().tolist()
+
+        results_list = []
+        start = 0
+        for text_labels in labels:
+            end = start + len(text_labels)
+            results_list.append(dict(zip(text_labels, probs_label_is_true[start:end])))
+            start = end
+
+        if not is_list:
+            return results_list[0]
 
-            return results
\ No newline at end of file
+        return results_list
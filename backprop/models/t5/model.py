@@ -171,7 +171,8 @@ class T5(TextGenerationModel, Finetunable):
     def finetune(self, params, max_input_length=128, max_output_length=32,
                  validation_split: float=0.15, epochs: int=20,
                  batch_size: int=None, early_stopping: bool = True,
-                 trainer: pl.Trainer = None, task: str = "text-generation"):
+                 trainer: pl.Trainer = None, task: str = "text-generation",
+                 use_gradient_checkpointing: bool = False):
         """
         Finetunes T5 for the text-generation task.
         
@@ -189,6 +190,7 @@ class T5(TextGenerationModel, Finetunable):
             early_stopping: Boolean that determines whether to automatically stop when validation loss stops improving
             trainer: Your custom pytorch_lightning trainer
             task: Task on which finetuning will occur. Must be in ["text-generation", "summarisation", "emotion", "qa"]
+            use_gradient_checkpointing: Boolean that determines whether to lower memory usage at the cost of slower training (raises ValueError if the model does not support it)
 
         Examples::
 
@@ -234,4 +236,5 @@ class T5(TextGenerationModel, Finetunable):
 
         Finetunable.finetune(self, dataset, validation_split=validation_split,
             epochs=epochs, batch_size=batch_size, optimal_batch_size=OPTIMAL_BATCH_SIZE,
-            early_stopping=early_stopping, trainer=trainer)
\ No newline at end of file
+            early_stopping=early_stopping, trainer=trainer,
+            use_gradient_checkpointing=use_gradient_checkpointing)
\ No newline at end of file
@@ -2,7 +2,30 @@ from typing import List, Tuple, Union, Dict
 from backprop.models import GPT2Large, T5QASummaryEmotion, BaseModel, T5
 from .base import Task
 
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is optional, but much faster at (de)serialising large payloads
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Generation requests are safe to repeat, so retry them on transient gateway errors.
+# The final response is still returned (not raised) so that it is handled as before.
+_RETRY_KWARGS = {"total": 3, "backoff_factor": 0.3, "status_forcelist": [502, 503, 504],
+                "raise_on_status": False}
+try:
+    _RETRY = Retry(allowed_methods=frozenset({"POST"}), **_RETRY_KWARGS)
+except TypeError:
+    # urllib3 < 1.26
+    _RETRY = Retry(method_whitelist=frozenset({"POST"}), **_RETRY_KWARGS)
+
+# Reuse connections across API calls instead of doing a new handshake every time
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=_RETRY))
 
 DEFAULT_LOCAL_MODEL = GPT2Large
 
@@ -82,8 +105,14 @@ class TextGeneration(Task):
         else:
             task_input["model"] = self.model 
 
-            res = requests.post("https://api.backprop.co/text-generation", json=task_input,
-                                headers={"x-api-key": self.api_key}).json()
+            if orjson:
+                body = orjson.dumps(task_input)
+            else:
+                body = json.dumps(task_input).encode("utf-8")
+
+            res = _SESSION.post("https://api.backprop.co/text-generation", data=body,
+                                headers={"x-api-key": self.api_key, "Content-Type": "application/json"})
+            res = orjson.loads(res.content) if orjson else res.json()
 
             if res.get("message"):
                 raise Exception(f"Failed to make API request: {res['message']}")
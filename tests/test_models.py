@@ -0,0 +1,43 @@
+from backprop.models.generic_models import conv1d_to_linear
+from transformers import GPT2Config, GPT2LMHeadModel
+from transformers.modeling_utils import Conv1D
+import torch
+
+# Small randomly initialised GPT-2, so nothing has to be downloaded
+tiny_gpt2_config = GPT2Config(vocab_size=100, n_positions=64, n_ctx=64,
+                            n_embd=32, n_layer=2, n_head=2)
+
+
+def test_conv1d_to_linear_layer():
+    module = torch.nn.Sequential(Conv1D(16, 8))
+    x = torch.randn(2, 5, 8)
+    expected = module(x)
+
+    conv1d_to_linear(module)
+    assert isinstance(module[0], torch.nn.Linear), "Conv1D not replaced"
+    assert torch.allclose(module(x), expected, atol=1e-6), "Linear output differs from Conv1D"
+
+
+def test_conv1d_to_linear_gpt2():
+    model = GPT2LMHeadModel(tiny_gpt2_config).eval()
+    input_ids = torch.randint(0, 100, (2, 10))
+
+    with torch.no_grad():
+        expected = model(input_ids)[0]
+        conv1d_to_linear(model)
+        out = model(input_ids)[0]
+
+    assert not any(isinstance(m, Conv1D) for m in model.modules()), "Conv1D layers left in the model"
+    assert torch.allclose(out, expected, atol=1e-5), "Model output changed"
+
+
+def test_int8_gpt2_generation():
+    model = GPT2LMHeadModel(tiny_gpt2_config).eval()
+    conv1d_to_linear(model)
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    input_ids = torch.randint(0, 100, (1, 5))
+
+    with torch.no_grad():
+        tokens = model.generate(input_ids, do_sample=False, max_length=15, pad_token_id=0)
+
+    assert tokens.shape == (1, 15), "Quantized generation did not run to max_length"
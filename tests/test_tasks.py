@@ -163,4 +163,45 @@ def test_text_generation_single():
 def test_text_generation_bulk():
     out = text_generation(["This is something", "This is something too"])
     assert isinstance(out, list), "Output not a list"
-    assert len(out) == 2, "Incorrect number of outputs"
\ No newline at end of file
+    assert len(out) == 2, "Incorrect number of outputs"
+
+def test_text_generation_prefix():
+    model = text_generation.model
+    prefix = "This is "
+    texts = ["something", "something a lot longer than the other input"]
+    out = model.generate(texts, prefix=prefix, do_sample=False, max_length=30)
+    assert isinstance(out, list), "Output not a list"
+    assert len(out) == 2, "Incorrect number of outputs"
+
+    # Generate from the same tokens without the cached past
+    prefix_ids = model.tokenizer(prefix, return_tensors="pt")["input_ids"]
+    for text, output in zip(texts, out):
+        text_ids = model.tokenizer(text, return_tensors="pt")["input_ids"]
+        input_ids = torch.cat([prefix_ids, text_ids], dim=1).to(model._model_device)
+
+        with torch.no_grad():
+            tokens = model.model.generate(input_ids, do_sample=False, max_length=30,
+                                        pad_token_id=model.tokenizer.eos_token_id)
+
+        expected = model.tokenizer.decode(tokens[0], skip_special_tokens=True)
+        assert output == expected, "Cached prefix changes the output"
+
+
+def test_text_generation_batch_matches_single():
+    model = text_generation.model
+    texts = ["Hi", "This is something that is a lot longer than the other inputs are", "Hi", "This is"]
+    out = model.generate(texts, do_sample=False, max_length=30)
+
+    for text, output in zip(texts, out):
+        single = model.generate(text, do_sample=False, max_length=30)
+        assert output == single, "Batching changes the output of an input"
+
+
+def test_text_generation_order():
+    model = text_generation.model
+    texts = ["This is something that is a lot longer than the other inputs are", "Hi", "This is"]
+    out = model.generate(texts, batch_size=1, do_sample=False, max_length=40)
+    assert len(out) == len(texts), "Incorrect number of outputs"
+
+    for text, output in zip(texts, out):
+        assert output.startswith(text), "Outputs not in the same order as the inputs"